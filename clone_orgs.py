@@ -4,14 +4,16 @@ Note that we don't clone private repos or forked repos.
 import datetime
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from timeit import default_timer
 
 from git import Repo  # pip install gitpython
 
-from utils import dicts2json, folder_del, folder_size, github_allpages
+from settings import get_settings
+from utils import dicts2json, folder_del, folder_size, github_allpages, github_session
 
 # Configuration settings are stored in config.json.
-SETTINGS = json.loads(open("config.json").read())
+SETTINGS = get_settings()
 
 
 def non_empty_folder(folder):
@@ -27,10 +29,51 @@ def non_empty_folder(folder):
     return True
 
 
-def org_clone(org):
+def clone_options():
+    """Return the git clone options to use, based on config.json settings.
+
+    search.py only reads files at HEAD, so by default we do a shallow,
+    single-branch clone without tags, and let git fetch only the blobs that
+    are needed for the checkout. Set "clone_depth" to 0 for a full clone.
+
+    Bare clones have no checkout, and search.py reads every blob at HEAD from
+    them, so we don't filter blobs (that would cause a fetch for each blob).
+    """
+    depth = SETTINGS.get("clone_depth", 1)
+    if not depth:
+        return []
+    options = [f"--depth={depth}", "--single-branch", "--no-tags"]
+    if not SETTINGS.get("bare_clones", False):
+        options.append("--filter=blob:none")
+    return options
+
+
+def _clone_one(org, repo, size_api):
+    """Clone a single repo into its folder under the org folder.
+
+    Runs in a worker thread of org_clone(). Returns a tuple of
+    (repo, size_api, size_actual, elapsed), where size_actual is in KB.
+    """
+    start = default_timer()
+    folder = os.path.join(SETTINGS["folder"], org, repo)
+
+    Repo.clone_from(
+        "https://github.com/" + org + "/" + repo + ".git",
+        folder,
+        multi_options=clone_options(),
+        bare=SETTINGS.get("bare_clones", False),
+    )
+
+    size_actual = folder_size(folder) / 1024
+    elapsed = default_timer() - start
+    return (repo, size_api, size_actual, elapsed)
+
+
+def org_clone(org, session=None):
     """Clone all public non-forked repos from the specified org.
 
     Repos are cloned to subfolders under the 'folder' setting in config.json.
+    session = optional Requests session to use for GitHub API calls
     """
     # optional list of org/repos to be skipped ...
     if os.path.isfile("skiplist.txt"):
@@ -58,52 +101,69 @@ def org_clone(org):
 
     tot_estimate = 0  # total estimated repo size (from GitHub API)
     tot_actual = 0  # total actual size on disk
-    tot_seconds = 0  # total elapsed time
 
-    for repo, size_api in repolist(org):
-
-        if f"{org}/{repo}".lower() in skiplist:
-            continue  # repos in skiplist are not cloned
-
-        start = default_timer()
-        folder = os.path.join(org_folder, repo)
-
-        if not SETTINGS["overwrite"]:
-            # Don't clone this repo if target folder exists and is non-empty.
-            if non_empty_folder(folder):
+    repos = repolist(org, session=session)
+    start = default_timer()  # total elapsed (wall) time of the clones
+
+    # Each clone is independent network/disk-bound work, so we run them in a
+    # thread pool. Results are printed and logged here in the main thread as
+    # they complete, so output and logfile.csv writes never interleave.
+    # The log file is kept open (and buffered) until all clones are done.
+    with open(logfile, "a", buffering=1 << 16) as log_fh, ThreadPoolExecutor(
+        max_workers=SETTINGS.get("clone_workers", 8)
+    ) as pool:
+        futures = {}  # future -> repo name
+        for repo, size_api in repos:
+
+            if f"{org}/{repo}".lower() in skiplist:
+                continue  # repos in skiplist are not cloned
+
+            if not SETTINGS["overwrite"]:
+                # Don't clone this repo if target folder exists and is non-empty.
+                if non_empty_folder(os.path.join(org_folder, repo)):
+                    continue
+
+            futures[pool.submit(_clone_one, org, repo, size_api)] = repo
+
+        for future in as_completed(futures):
+            try:
+                repo, size_api, size_actual, elapsed = future.result()
+            except Exception as error:  # pylint: disable=W0703
+                # Report the failed clone and keep going, so that the other
+                # clones are still printed and logged. Remove whatever was
+                # cloned, so that the next run doesn't skip this repo.
+                repo = futures[future]
+                print(f"{org:20} {repo:60}   CLONE FAILED: {error}")
+                folder_del(os.path.join(org_folder, repo))
                 continue
 
-        print(f"{org:20} {repo:60}   ", end="")
-
-        Repo.clone_from("https://github.com/" + org + "/" + repo + ".git", folder)
-
-        size_actual = folder_size(folder) / 1024
-        elapsed = default_timer() - start
+            tot_estimate += size_api
+            tot_actual += size_actual
 
-        tot_estimate += size_api
-        tot_actual += size_actual
-        tot_seconds += elapsed
-
-        print(
-            f"{size_api:9,.0f}   {size_actual:9,.0f} {elapsed:7.2f} {size_actual/elapsed:7.0f}"
-        )
+            print(
+                f"{org:20} {repo:60}   "
+                f"{size_api:9,.0f}   {size_actual:9,.0f} {elapsed:7.2f} {size_actual/elapsed:7.0f}"
+            )
 
-        timestamp = str(datetime.datetime.now())[:19]
-        open(logfile, "a").write(
-            ",".join(
-                [
-                    timestamp,
-                    org,
-                    repo,
-                    str(round(size_api)),
-                    str(round(size_actual)),
-                    str(round(elapsed, 2)),
-                    str(round(size_actual / elapsed)),
-                ]
+            timestamp = str(datetime.datetime.now())[:19]
+            log_fh.write(
+                ",".join(
+                    [
+                        timestamp,
+                        org,
+                        repo,
+                        str(round(size_api)),
+                        str(round(size_actual)),
+                        str(round(elapsed, 2)),
+                        str(round(size_actual / elapsed)),
+                    ]
+                )
+                + "\n"
             )
-            + "\n"
-        )
 
+    # Clones run concurrently, so the total is wall time, not the sum of the
+    # per-repo times.
+    tot_seconds = default_timer() - start
     avg_kb_per_second = 0 if tot_seconds == 0 else tot_actual / tot_seconds
     print(
         "TOTALS:".rjust(84) + f"{tot_estimate:9,.0f}   {tot_actual:9,.0f} "
@@ -111,7 +171,7 @@ def org_clone(org):
     )
 
 
-def repolist(orgname, refresh=True):
+def repolist(orgname, refresh=True, session=None):
     """Return list of repos for a GitHub organization.
 
     If refresh=False, we use the cached data in /data/repos{orgname}.json and
@@ -127,7 +187,7 @@ def repolist(orgname, refresh=True):
         repodata = json.loads(open(filename, "r").read())  # read cached data
     else:
         endpoint = "/orgs/" + orgname.lower() + "/repos?per_page=100"
-        repodata = github_allpages(endpoint=endpoint)
+        repodata = github_allpages(endpoint=endpoint, session=session)
         dicts2json(repodata, filename)
         print(
             f"\r{orgname} - {len(repodata)} total public non-forked repos found"
@@ -148,6 +208,7 @@ if __name__ == "__main__":
     if not os.path.isdir(SETTINGS["folder"]):
         os.mkdir(SETTINGS["folder"])
 
-    # refresh the cache
+    # refresh the cache, using one GitHub API session for all orgs
+    SESSION = github_session()
     for ORG in SETTINGS["organizations"]:
-        org_clone(ORG)
+        org_clone(ORG, session=SESSION)
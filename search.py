@@ -3,52 +3,192 @@ to matches.csv and repos.csv.
 
 Assumes clone_orgs.py has already been run to clone the repos.
 """
+import hashlib
 import json
+import mmap
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-from utils import file_url, latest_commit
+from git import Repo  # pip install gitpython
 
+from settings import get_settings
+from utils import bare_clone, file_url, latest_commit
 
-SETTINGS = json.loads(open("config.json").read())  # read config file
+
+SETTINGS = get_settings()  # read config file
+
+WORDS = SETTINGS["words"]  # words to search for
+FOLDER = SETTINGS["folder"]  # root folder of the cloned repos
+
+# file extensions to be searched, lower-case without the leading "."
+FILETYPES = frozenset(filetype.lower().lstrip(".") for filetype in SETTINGS["filetypes"])
+
+# folders that are not searched (repo metadata and vendored dependencies)
+SKIP_FOLDERS = frozenset([".git", ".github", "vendor", "node_modules"])
+
+# generated files that are not searched, even if their file type is
+SKIP_FILES = frozenset(["package-lock.json", "yarn.lock", "poetry.lock", "Cargo.lock"])
+
+# Files with a null byte in this many leading bytes are treated as binary,
+# and not searched.
+BINARY_CHECK_SIZE = 4096
+
+# lower-case search words as UTF-8 bytes, in the same order as SETTINGS["words"]
+SEARCH_WORDS = [word.lower().encode("utf-8") for word in WORDS]
+
+# search words that can overlap themselves (e.g., "abab"), which need extra
+# handling where they span two chunks in count_words_mapped()
+OVERLAPPING_WORDS = frozenset(
+    word
+    for word in SEARCH_WORDS
+    if any(word[:length] == word[-length:] for length in range(1, len(word)))
+)
+
+# If all of the search words are ASCII, file content can be lower-cased by
+# translating the bytes A-Z to a-z, without decoding it.
+ASCII_WORDS = all(word.isascii() for word in SEARCH_WORDS)
+LOWER_TABLE = bytes.maketrans(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", b"abcdefghijklmnopqrstuvwxyz")
+
+# Files larger than this are memory-mapped and searched in chunks of this
+# size, instead of being read into memory all at once.
+MMAP_SIZE = 1 << 20
 
 
 def empty_repo_totals():
     """Return the dict structure used to track repo totals.
     """
     temp = {"folder": "", "*TOTAL*": 0}
-    for word in SETTINGS["words"]:
+    for word in WORDS:
         temp[word] = 0
     return temp
 
 
-def repo_folder(folder_path):
-    """Determine whether a path is the root folder of a cloned repo.
-    Returns True if a repo root folder, False otherwise.
+def count_words(filename, file_content):
+    """Counts the words specified in SETTINGS["words"] in a file's content,
+    which must be bytes that have been lower-cased by lower_content().
+    Returns a dict with keys for each of the search words (values are # hits),
+    as well as a "*TOTAL*" key that is the total number of matches found.
+    """
+    counts = {word: file_content.count(word) for word in SEARCH_WORDS}
+    return hit_counts(filename, counts)
+
+
+def count_words_mapped(filename, file_map):
+    """Counts the words specified in SETTINGS["words"] in a memory-mapped
+    file, which is lower-cased and searched a chunk at a time. Each chunk
+    is searched along with the end of the previous chunk, so that words
+    spanning two chunks are found. Only works for ASCII search words.
+    Returns the same dict as count_words().
     """
-    # After removing SETTINGS["folder"], should have a path of the form
-    # /orgname/repo ...
-    sub_path = folder_path.replace(SETTINGS["folder"], "")
-    # Convert Windows backslashes (if any) to forward slashes ...
-    sub_path = sub_path.replace("\\", "/")
-    # If this sub-path has exactly two separators, it's the root folder
-    # of a repo ...
-    return sub_path.count("/") == 2
+    overlap = max(len(word) for word in SEARCH_WORDS) - 1
+    counts = dict.fromkeys(SEARCH_WORDS, 0)
+    resume = dict.fromkeys(SEARCH_WORDS, 0)  # where each word's count resumes
+    for chunk_start in range(0, len(file_map), MMAP_SIZE):
+        offset = max(chunk_start - overlap, 0)
+        chunk = file_map[offset : chunk_start + MMAP_SIZE].translate(LOWER_TABLE)
+        for word in SEARCH_WORDS:
+            start = resume[word] - offset
+            matches = chunk.count(word, start)
+            counts[word] += matches
+            resume[word] = offset + resume_position(chunk, word, start, matches)
+    return hit_counts(filename, counts)
+
+
+def resume_position(chunk, word, start, matches):
+    """Return the position in a chunk where counting a word should resume
+    in the next chunk, after chunk.count(word, start) found the specified
+    number of matches. Words that start at or after the returned position
+    span the end of the chunk, and haven't been counted yet.
+    """
+    safe_end = max(len(chunk) - len(word) + 1, start)
+    if word not in OVERLAPPING_WORDS:
+        return safe_end
+    if chunk.rfind(word, start) + len(word) <= safe_end:
+        return safe_end  # no occurrence ends after safe_end
+    if chunk.count(word, start, safe_end) == matches:
+        return safe_end  # an occurrence ends after safe_end, but wasn't counted
+    # The last match ends after safe_end, and a word that can overlap itself
+    # must resume after that match, the same as bytes.count(). Find the end
+    # of the last match: the shortest slice that still has all the matches.
+    low, high = safe_end + 1, len(chunk)
+    while low < high:
+        middle = (low + high) // 2
+        if chunk.count(word, start, middle) == matches:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def hit_counts(filename, counts):
+    """Convert the counts for each lower-case search word to the dict
+    returned by count_words().
+    """
+    hits = {"filename": filename, "*TOTAL*": 0}
+    for searchfor, word in zip(WORDS, SEARCH_WORDS):
+        hits[searchfor] = counts[word]
+        hits["*TOTAL*"] += counts[word]
+    return hits
+
+
+def lower_content(file_content):
+    """Lower-case a file's content (bytes) for case-insensitive search.
+    """
+    if ASCII_WORDS:
+        return file_content.translate(LOWER_TABLE)
+    # Non-ASCII search words need Unicode-aware lower-casing.
+    return file_content.decode("utf-8", errors="replace").lower().encode("utf-8")
 
 
 def search_file(filename):
     """Searches a file for the words specified in SETTINGS["words"].
-    Case-insensitive search.
+    Case-insensitive search. Binary files are not searched (no hits).
     Returns a dict with keys for each of the search words (values are # hits),
     as well as a "*TOTAL*" key that is the total number of matches found.
     """
-    hit_counts = {"filename": filename, "*TOTAL*": 0}
-    with open(filename, "r", encoding="utf-8", errors="replace") as file_handle:
-        file_content = file_handle.read().lower()
-    for searchfor in SETTINGS["words"]:
-        matches = file_content.count(searchfor.lower())
-        hit_counts[searchfor] = matches
-        hit_counts["*TOTAL*"] += matches
-    return hit_counts
+    with open(filename, "rb") as file_handle:
+        if b"\0" in file_handle.read(BINARY_CHECK_SIZE):
+            return hit_counts(filename, dict.fromkeys(SEARCH_WORDS, 0))
+        file_handle.seek(0)
+        file_size = os.fstat(file_handle.fileno()).st_size
+        if file_size > MMAP_SIZE and ASCII_WORDS:
+            # Search large files in place, rather than reading them into memory.
+            with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+                return count_words_mapped(filename, file_map)
+        file_content = lower_content(file_handle.read())
+    return count_words(filename, file_content)
+
+
+def search_bare_repo(folder):
+    """Searches the files at HEAD of a bare repo for the words specified in
+    SETTINGS["words"], reading the blobs directly from the object database.
+    Yields the hit counts (as returned by search_file) for each file searched.
+    """
+    # The Repo is closed when the traversal is done, to clean up GitPython's
+    # git helper processes (and their open files) right away.
+    with Repo(folder) as repo:
+        try:
+            tree = repo.head.commit.tree
+        except ValueError:
+            return  # empty repo, no commits
+        for item in tree.traverse(prune=skip_tree):
+            if item.type != "blob":
+                continue
+            _, dot, extension = item.name.rpartition(".")
+            if not dot or extension.lower() not in FILETYPES or item.name in SKIP_FILES:
+                continue
+            file_content = item.data_stream.read()
+            if b"\0" in file_content[:BINARY_CHECK_SIZE]:
+                continue  # binary file
+            file_content = lower_content(file_content)
+            yield count_words(os.path.join(folder, item.path), file_content)
+
+
+def skip_tree(item, depth):  # pylint: disable=W0613
+    """Prune function for traversing a bare repo's tree, to skip the same
+    folders that search_repo() skips in working trees.
+    """
+    return item.type == "tree" and item.name in SKIP_FOLDERS
 
 
 def search_repos():
@@ -63,66 +203,175 @@ def search_repos():
     """
 
     # Create/open the output CSV files.
-    matches_file = open("matches.csv", "w")
-    matches_file.write(f"url,{','.join(SETTINGS['words'])},total\n")
-    repos_file = open("repos.csv", "w")
-    repos_file.write(f"url,{','.join(SETTINGS['words'])},total,branch,last_commit\n")
+    matches_file = open("matches.csv", "w", buffering=1 << 20)
+    matches_file.write(f"url,{','.join(WORDS)},total\n")
+    repos_file = open("repos.csv", "w", buffering=1 << 20)
+    repos_file.write(f"url,{','.join(WORDS)},total,branch,last_commit\n")
 
-    # We'll use this dict to aggregate totals for each repo searched.
-    repo_totals = empty_repo_totals()
+    # Repos that haven't changed since the last search (same latest commit,
+    # same search settings) use the cached results instead of searching again.
+    cache = search_cache_read()
+    signature = search_signature()
+    folders = repo_folders()
+    # (branch, SHA) of each repo, also written to repos.csv
+    commits = {folder: latest_commit(folder) for folder in folders}
+    new_cache = {}
+    for folder in folders:
+        cached = cache.get(cache_key(folder))
+        if (
+            cached
+            and commits[folder][1]
+            and cached["sha"] == commits[folder][1]
+            and cached["signature"] == signature
+        ):
+            new_cache[cache_key(folder)] = cached
+    to_search = [folder for folder in folders if cache_key(folder) not in new_cache]
 
-    for root, dirs, files in os.walk(SETTINGS["folder"]):
-        if "\\vendor\\" in root:
-            continue  # skip vendored code
-        if repo_folder(root):
-            # We're starting searching a new repo, so write totals for previous
-            # repo (if any).
-            if repo_totals["folder"]:
-                write_repo(repos_file, repo_totals)
-            repo_totals = empty_repo_totals()  # initialize new repo totals
-            repo_totals["folder"] = root
-        for filename in files:
-            _, extension = os.path.splitext(filename)
-            if extension.lower() in SETTINGS["filetypes"]:
-                # this is a file to be searched/analyzed
-                fullname = os.path.join(root, filename)
-                hits = search_file(fullname)
-                if hits["*TOTAL*"] > 0:
-                    write_matches(matches_file, hits)
-                    # Add this file's hit counts to the repo's totals.
-                    for word in SETTINGS["words"]:
-                        repo_totals[word] += hits[word]
-                    repo_totals["*TOTAL*"] += hits["*TOTAL*"]
-
-        # Remove the folders we're not interested in searching.
-        if ".git" in dirs:
-            dirs.remove(".git")
-        if ".github" in dirs:
-            dirs.remove(".github")
-
-    write_repo(repos_file, repo_totals)  # write the final repo's totals
+    # Each repo is searched in a separate process, and the results are written
+    # here in the main process, in the same order as the repo folders.
+    # Lines for matches.csv are buffered and written in batches.
+    match_lines = []
+    # max_workers=None uses one process per CPU (at most 61 on Windows, where
+    # ProcessPoolExecutor doesn't allow more).
+    with ProcessPoolExecutor(max_workers=None) as pool:
+        results = pool.map(search_repo, to_search)
+        for folder in folders:
+            if cache_key(folder) in new_cache:
+                cached = new_cache[cache_key(folder)]
+                repo_totals, match_hits = cached["totals"], cached["matches"]
+            else:
+                repo_totals, match_hits = next(results)
+                new_cache[cache_key(folder)] = {
+                    "sha": commits[folder][1],
+                    "signature": signature,
+                    "totals": repo_totals,
+                    "matches": match_hits,
+                }
+            for hits in match_hits:
+                write_matches(match_lines, hits)
+            if len(match_lines) >= 1024:
+                matches_file.writelines(match_lines)
+                match_lines.clear()
+            write_repo(repos_file, repo_totals, commits[folder])
+    matches_file.writelines(match_lines)
 
     matches_file.close()
     repos_file.close()
+    search_cache_write(new_cache)
+
+
+def cache_key(folder):
+    """Return the search cache key for a repo folder: "org/repo"."""
+    return os.path.relpath(folder, FOLDER).replace("\\", "/")
+
+
+def search_cache_read():
+    """Read the cached search results from the last search_repos() run.
+    Returns a dict with a key for each repo (see cache_key()), or an empty
+    dict if there are no (readable) cached results.
+    """
+    filename = os.path.join(FOLDER, ".search_cache.json")
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, "r", encoding="utf-8") as fhandle:
+        try:
+            return json.loads(fhandle.read())
+        except json.JSONDecodeError:
+            return {}  # truncated or corrupt cache, search all repos again
+
+
+def search_cache_write(cache):
+    """Write the search results cache for the next search_repos() run."""
+    if not os.path.isdir(FOLDER):
+        return  # no cloned repos, so nothing to cache
+    filename = os.path.join(FOLDER, ".search_cache.json")
+    with open(filename, "w", encoding="utf-8") as fhandle:
+        fhandle.write(json.dumps(cache))
+
+
+def search_signature():
+    """Return a hash of the settings that affect search results, to detect
+    cached results that were created with different settings.
+    """
+    settings = [sorted(WORDS), sorted(FILETYPES), FOLDER]
+    return hashlib.blake2b(json.dumps(settings).encode("utf-8")).hexdigest()
+
+
+def repo_folders():
+    """Return a list of the root folders of all cloned repos, which are
+    the subfolders of each org folder under SETTINGS["folder"].
+    """
+    if not os.path.isdir(FOLDER):
+        return []  # nothing has been cloned
+    folders = []
+    for org in sorted(next(os.walk(FOLDER))[1]):
+        org_folder = os.path.join(FOLDER, org)
+        for repo in sorted(next(os.walk(org_folder))[1]):
+            folders.append(os.path.join(org_folder, repo))
+    return folders
+
+
+def search_repo(folder):
+    """Search a cloned repo for the words specified in SETTINGS["words"].
+
+    Runs in a worker process of search_repos(). Returns a tuple of the
+    repo's totals and a list of the hit counts for files with matches.
+    """
+    repo_totals = empty_repo_totals()
+    repo_totals["folder"] = folder
+    match_hits = []
+
+    if bare_clone(folder):
+        # Bare clone: search the blobs at HEAD, there's nothing to walk.
+        for hits in search_bare_repo(folder):
+            add_hits(match_hits, repo_totals, hits)
+        return (repo_totals, match_hits)
+
+    for root, dirs, files in os.walk(folder):
+        # Remove the folders we're not interested in searching, before
+        # os.walk() descends into them.
+        dirs[:] = [subfolder for subfolder in dirs if subfolder not in SKIP_FOLDERS]
+        for filename in files:
+            _, dot, extension = filename.rpartition(".")
+            if not dot or extension.lower() not in FILETYPES or filename in SKIP_FILES:
+                continue
+            # this is a file to be searched/analyzed
+            fullname = os.path.join(root, filename)
+            add_hits(match_hits, repo_totals, search_file(fullname))
+
+    return (repo_totals, match_hits)
+
+
+def add_hits(match_hits, repo_totals, hits):
+    """Add a file's hit counts to the repo's totals, and to the list of
+    files with matches if it has any matches.
+    """
+    if hits["*TOTAL*"] == 0:
+        return
+    match_hits.append(hits)
+    for word in WORDS:
+        repo_totals[word] += hits[word]
+    repo_totals["*TOTAL*"] += hits["*TOTAL*"]
 
 
-def write_matches(file, data):
-    """Write a line to the matches.csv file.
+def write_matches(lines, data):
+    """Add a line for the matches.csv file to a list of buffered lines.
     """
     line = file_url(data["filename"])
-    for word in SETTINGS["words"]:
+    for word in WORDS:
         line += f",{data[word]}"
-    file.write(f"{line},{data['*TOTAL*']}\n")
+    lines.append(f"{line},{data['*TOTAL*']}\n")
 
 
-def write_repo(file, data):
+def write_repo(file, data, commit):
     """Write a line to the repos.csv file.
+    commit = the repo's (branch, SHA) tuple, as returned by latest_commit()
     """
     if data["*TOTAL*"] == 0:
         return  # don't include repos with no matches
-    branch, commit_sha = latest_commit(data["folder"])
+    branch, commit_sha = commit
     line = file_url(data["folder"])
-    for word in SETTINGS["words"]:
+    for word in WORDS:
         line += f",{data[word]}"
     file.write(f"{line},{data['*TOTAL*']},{branch},{commit_sha}\n")
 
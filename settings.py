@@ -0,0 +1,13 @@
+"""Configuration settings, which are stored in config.json.
+"""
+import functools
+import json
+import pathlib
+
+
+@functools.lru_cache(maxsize=1)
+def get_settings():
+    """Return the settings from config.json as a dictionary.
+    The file is only read and parsed once; later calls return the same dict.
+    """
+    return json.loads(pathlib.Path("config.json").read_text())
@@ -1,14 +1,31 @@
 """miscellaneous utilities/helper functions
 """
 import contextlib
+import hashlib
 import json
 import os
+import re
 import shutil
+import stat
+import subprocess
+import sys
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-SETTINGS = json.loads(open("config.json").read())  # read config file
+from settings import get_settings
+
+SETTINGS = get_settings()  # read config file
+
+# default authentication for GitHub API calls: (username, PAT)
+DEFAULT_AUTH = (SETTINGS["username"], SETTINGS["PAT"])
+
+# regexes for parsing the 'link' HTTP header returned by GitHub API
+LINK_REGEX = re.compile(r'<([^>]+)>;\s*rel="([^"]+)"')
+PAGE_REGEX = re.compile(r"[?&]page=(\d+)")
 
 
 def dicts2json(source=None, filename=None):
@@ -43,28 +60,86 @@ def folder_del(path):
     """Delete a folder and its contents."""
     if not os.path.isdir(path):
         return
+    if os.name == "nt":
+        # On Windows, rmdir is much faster than deleting each file from Python.
+        subprocess.run(
+            ["cmd", "/c", "rmdir", "/s", "/q", os.path.normpath(path)],
+            capture_output=True,
+            check=False,
+        )
+        if not os.path.isdir(path):
+            return
     with contextlib.suppress(OSError):
-        shutil.rmtree(path, onerror=folder_del_onerror)
+        if sys.version_info >= (3, 12):
+            shutil.rmtree(path, onexc=folder_del_onerror)
+        else:
+            shutil.rmtree(path, onerror=folder_del_onerror)
 
 
 def folder_del_onerror(action, name, exc): # pylint: disable=W0613
     """Error handler for folder_del(), to delete read-only files."""
-    os.chmod(name, 128)  # clear read-only attribute
-    time.sleep(0.1)  # this seems to eliminate intermittent PermissionError
-    os.remove(name)
+    os.chmod(name, stat.S_IWRITE)  # clear read-only attribute
+    try:
+        os.remove(name)
+    except PermissionError:
+        time.sleep(0.05)  # retry once, for intermittent PermissionError
+        os.remove(name)
 
 
 def folder_size(path):
-    """Return total size of a folder, including contents/subfolders."""
+    """Return total size of a folder, including contents/subfolders.
+
+    Folders with enough subfolders are scanned with a thread pool, to overlap
+    the latency of the scandir/stat calls.
+    """
     if not os.path.isdir(path):
         return 0
+    total_bytes, subfolders = scan_folder(path)
+    if len(subfolders) <= 4:
+        # not enough fan-out to be worth starting threads
+        for subfolder in subfolders:
+            total_bytes += _folder_size_serial(subfolder)
+        return total_bytes
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        pending = {pool.submit(scan_folder, subfolder) for subfolder in subfolders}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder_bytes, subfolders = future.result()
+                total_bytes += folder_bytes
+                pending.update(pool.submit(scan_folder, sub) for sub in subfolders)
+    return total_bytes
+
+
+def _folder_size_serial(path):
+    """Return total size of a folder, without using threads.
+    Uses a stack of folders to be scanned, rather than recursion.
+    """
     total_bytes = 0
+    folders = [path]
+    while folders:
+        for entry in os.scandir(folders.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            else:
+                total_bytes += entry.stat(follow_symlinks=False).st_size
+    return total_bytes
+
+
+def scan_folder(path):
+    """Scan a single folder (not its subfolders).
+    Returns a tuple of the total size of the files in the folder and a list
+    of the paths of its subfolders.
+    """
+    total_bytes = 0
+    subfolders = []
     for entry in os.scandir(path):
         if entry.is_dir(follow_symlinks=False):
-            total_bytes += folder_size(entry.path)
+            subfolders.append(entry.path)
         else:
             total_bytes += entry.stat(follow_symlinks=False).st_size
-    return total_bytes
+    return (total_bytes, subfolders)
 
 
 def github_allpages(endpoint=None, auth=None, headers=None, state=None, session=None):
@@ -78,6 +153,9 @@ def github_allpages(endpoint=None, auth=None, headers=None, state=None, session=
     """
 
     headers = {} if not headers else headers
+    if session is None and state is None:
+        # use one session (and connection) for all pages
+        session = github_session()
 
     payload = []  # the full data set (all fields, all pages)
     page_endpoint = endpoint  # endpoint of each page in the loop below
@@ -140,19 +218,80 @@ def github_pagination(link_header):
         except KeyError:
             return retval  # no Link HTTP header found, nothing to parse
 
-    links = link_string.split(",")
-    for link in links:
-        # link format = '<url>; rel="type"'
-        linktype = link.split(";")[-1].split("=")[-1].strip()[1:-1]
-        url = link.split(";")[0].strip()[1:-1]
-        pageno = url.split("?")[-1].split("=")[-1].strip()
-
-        retval[linktype + "page"] = pageno
+    # link format = '<url>; rel="type"'
+    for url, linktype in LINK_REGEX.findall(link_string):
+        pageno = PAGE_REGEX.search(url)
+        retval[linktype + "page"] = int(pageno.group(1)) if pageno else 0
         retval[linktype + "URL"] = url
 
     return retval
 
 
+def github_cache_file(url):
+    """Return the filename of the cached GitHub API response for a URL."""
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return os.path.join(SETTINGS["folder"], ".gh_cache", key + ".json")
+
+
+def github_cache_read(url):
+    """Read the cached GitHub API response for a URL.
+    Returns a dict with etag, last_modified, link and body keys, or None if
+    the URL has no (readable) cached response.
+    """
+    filename = github_cache_file(url)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, "r", encoding="utf-8") as fhandle:
+        try:
+            cached = json.loads(fhandle.read())
+        except json.JSONDecodeError:
+            return None  # truncated or corrupt cache file, don't use it
+    if not isinstance(cached, dict) or any(
+        key not in cached for key in ("etag", "last_modified", "link", "body")
+    ):
+        return None
+    return cached
+
+
+def github_cache_write(url, response):
+    """Cache a GitHub API response, if it can be validated by a conditional
+    request (i.e., it has an ETag or Last-Modified header).
+    """
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if not etag and not last_modified:
+        return
+    filename = github_cache_file(url)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    cached = {
+        "etag": etag,
+        "last_modified": last_modified,
+        "link": response.headers.get("Link"),
+        "body": response.text,
+    }
+    # Write to a temporary file and then replace the cache file, so that an
+    # interrupted write can't leave a truncated cache file.
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w", encoding="utf-8") as fhandle:
+        fhandle.write(json.dumps(cached))
+    os.replace(temp_filename, filename)
+
+
+def github_session():
+    """Create a Requests session for GitHub API calls.
+
+    The session keeps connections alive across calls, and retries
+    requests that fail with a transient server error.
+    """
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=retries),
+    )
+    return session
+
+
 def github_rest_api(
         *, endpoint=None, auth=None, headers=None, state=None, session=None
     ):
@@ -185,8 +324,7 @@ def github_rest_api(
 
     # set auth to default if needed
     if not auth:
-        settings = json.loads(open("config.json").read())  # read config file
-        auth = (settings["username"], settings["PAT"])
+        auth = DEFAULT_AUTH
 
     # add the V3 Accept header to the dictionary
     headers = {} if not headers else headers
@@ -211,7 +349,25 @@ def github_rest_api(
     full_endpoint = (
         "https://api.github.com" + endpoint if endpoint[0] == "/" else endpoint
     )
+
+    # Send a conditional request if we have a cached response for this
+    # endpoint. GitHub returns 304 Not Modified (which doesn't count against
+    # the rate limit) if the data hasn't changed, and we use the cached body.
+    cached = github_cache_read(full_endpoint)
+    if cached:
+        if cached["etag"]:
+            headers_dict.setdefault("If-None-Match", cached["etag"])
+        if cached["last_modified"]:
+            headers_dict.setdefault("If-Modified-Since", cached["last_modified"])
     response = sess.get(full_endpoint, headers=headers_dict)
+    if cached and response.status_code == 304:
+        response.status_code = 200
+        response._content = cached["body"].encode("utf-8")  # pylint: disable=W0212
+        response.encoding = "utf-8"
+        if cached["link"]:
+            response.headers["Link"] = cached["link"]
+    elif response.status_code == 200:
+        github_cache_write(full_endpoint, response)
 
     if state and state.verbose:
         print("    Endpoint: " + endpoint)
@@ -248,20 +404,45 @@ def latest_commit(folder):
     Takes the folder of a local git repo, and returns a tuple of the
     default branch and SHA of the latest commit in that branch.
     """
-    git_heads_folder = os.path.join(folder, ".git\\refs\\heads")
-    try:
-        heads = next(os.walk(git_heads_folder))[2]
-    except StopIteration:
-        heads = None
-    if heads:
-        default_branch = heads[0]
-        with open(os.path.join(git_heads_folder, default_branch)) as fhandle:
-            commit_sha = fhandle.read().strip()
-    else:
-        default_branch = ""
-        commit_sha = ""
+    git_dir = folder if bare_clone(folder) else os.path.join(folder, ".git")
+    return head_commit(git_dir)
+
+
+def bare_clone(folder):
+    """Determine whether a cloned repo's folder is a bare clone (no working
+    tree), which is the case if it has no .git subfolder.
+    """
+    return not os.path.isdir(os.path.join(folder, ".git"))
+
 
-    return (default_branch, commit_sha)
+def head_commit(git_dir):
+    """Get the branch and commit SHA that HEAD points to, from a .git folder.
+    Uses packed-refs if the branch doesn't have a loose ref file.
+    Returns a tuple of (branch, SHA), or ("", "") if they can't be determined.
+    """
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as fhandle:
+            head = fhandle.readline().strip()
+    except OSError:
+        return ("", "")
+    if not head.startswith("ref: "):
+        return ("", head)  # detached HEAD contains the SHA itself
+
+    ref = head[5:]
+    branch = ref[len("refs/heads/"):] if ref.startswith("refs/heads/") else ref
+    try:
+        with open(os.path.join(git_dir, *ref.split("/"))) as fhandle:
+            return (branch, fhandle.read().strip())
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(git_dir, "packed-refs")) as fhandle:
+            for line in fhandle:
+                if line.rstrip("\n").endswith(" " + ref):
+                    return (branch, line.split(" ", 1)[0])
+    except OSError:
+        pass
+    return (branch, "")
 
 
 if __name__ == "__main__":